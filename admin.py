@@ -1,25 +1,36 @@
-import random
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import CallbackQueryHandler, ContextTypes
+from telegram.ext import CommandHandler, ContextTypes
+
+import dashboard
+import engine
+import metrics
+import profiling
+from outbox import notify, save
+from router import decode, register
+from stats import close_stats, leaderboard_text, open_stats
 
 from storage import (
     users,
-    games,
+    generations,
+    stats,
     awaiting_admin_codes,
     awaiting_special_codes,
     ADMIN_IDS,
+    GENERATION_TTL_DAYS,
     START_KEYBOARD,
     buttons,
 )
 from utils import (
     get_game,
+    get_room,
     is_admin,
     send_menu,
     get_name,
     number_to_square,
-    number_to_circle,
+    page,
+    page_buttons,
 )
 
 
@@ -52,27 +63,31 @@ async def player_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await query.answer()
     await query.message.delete()
     tg_id = query.from_user.id
-    game = get_game()
-    if not is_admin(game, tg_id):
+    room = get_room()
+    if not is_admin(room.game, tg_id):
         return
-    players = list(users.find({"telegram_id": {"$nin": game.get("admin_ids", [])}}))
-    players.sort(key=lambda p: p.get("number", 0))
+    _, args = decode(query.data)
+    players, has_prev, has_next = page(room.non_admins(), "number", args)
     if players:
         lines = []
         for p in players:
-            btn = buttons.find_one({"player_id": p["_id"], "special": False})
-            code = btn.get("code") if btn else None
+            btn = room.own_button(p)
+            code = btn.code if btn else None
             lines.append(
-                f"{get_name(p)} {number_to_square(p.get('number'))}{number_to_circle(p.get('number'))} "
+                f"{get_name(p)} {number_to_square(p.number)}{room.circle(p.number)} "
                 f"{code or '-'} "
-                f"{'в игре ✅' if p.get('alive', True) else 'заблокирован 🚫'}"
+                f"{'в игре ✅' if p.alive else 'заблокирован 🚫'}"
             )
         text = "Подключенные игроки:\n" + "\n".join(lines)
     else:
         text = "Нет подключенных игроков."
-    await context.bot.send_message(tg_id, text)
-    user = users.find_one({"telegram_id": tg_id})
-    await send_menu(tg_id, user, game, context)
+    keyboard = [
+        *page_buttons("player_list", players, "number", has_prev, has_next),
+        [InlineKeyboardButton("Назад", callback_data="back_to_menu")],
+    ]
+    await context.bot.send_message(
+        tg_id, text, reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
 
 async def show_pairs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -80,16 +95,18 @@ async def show_pairs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     await query.answer()
     await query.message.delete()
     tg_id = query.from_user.id
-    game = get_game()
-    if not is_admin(game, tg_id):
+    room = get_room()
+    if not is_admin(room.game, tg_id):
         return
-    pairs = list(buttons.find({"special": False}).sort("number", 1))
+    _, args = decode(query.data)
+    pairs, has_prev, has_next = page(room.buttons.values(), "number", args)
     text = "Пары:\n" + "\n".join(
-        f"{number_to_square(p['number'])} - {p['circle']} "
-        f"{'заблокирована' if p.get('blocked') else ('занята' if p.get('player_id') else 'свободна')}"
+        f"{number_to_square(p.number)} - {p.circle} "
+        f"{'заблокирована' if p.blocked else ('занята' if p.player_id else 'свободна')}"
         for p in pairs
     )
     keyboard = [
+        *page_buttons("show_pairs", pairs, "number", has_prev, has_next),
         [InlineKeyboardButton("Перемешать пары", callback_data="shuffle_pairs")],
         [InlineKeyboardButton("Назад", callback_data="back_to_menu")],
     ]
@@ -103,42 +120,49 @@ async def button_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await query.answer()
     await query.message.delete()
     tg_id = query.from_user.id
-    game = get_game()
-    if not is_admin(game, tg_id):
+    room = get_room()
+    if not is_admin(room.game, tg_id):
         return
-    pairs = list(
-        buttons.find({"special": False, "player_id": {"$ne": None}}).sort("number", 1)
+    _, args = decode(query.data)
+    pairs, has_prev, has_next = page(
+        [b for b in room.buttons.values() if b.player_id is not None], "number", args
     )
     lines = []
     for p in pairs:
-        number = number_to_square(p["number"])
-        circle = p["circle"]
-        player = users.find_one({"_id": p["player_id"]})
+        player = room.by_id.get(p.player_id)
         if not player:
             continue
         status = ["Есть игрок 👤"]
-        if not player.get("alive", True) or p.get("blocked"):
+        if not player.alive or p.blocked:
             status.append("Заблокирована 🚫")
-        elif p.get("code_used"):
+        elif p.code_used:
             status.append("На руках ✋")
         else:
             status.append("В игре ⛳")
-        lines.append(f"{number} {circle} - {', '.join(status)}")
-    specials = list(buttons.find({"special": True}))
+        lines.append(f"{number_to_square(p.number)} {p.circle} - {', '.join(status)}")
+    # Special buttons close the list, so they only go on its last page
+    specials = []
+    if not has_next:
+        specials = sorted(room.specials.values(), key=lambda s: s.slot)
     for s in specials:
         status = []
-        if s.get("blocked"):
+        if s.blocked:
             status.append("Заблокирована 🚫")
-        elif s.get("code_used"):
+        elif s.code_used:
             status.append("На руках ✋")
-        elif s.get("taken"):
+        elif s.taken:
             status.append("У игрока 👤")
         else:
             status.append("В игре ⛳")
-        lines.append(f"Особая {s.get('emoji', '🔀')} - {', '.join(status)}")
-    keyboard = [[InlineKeyboardButton("Назад", callback_data="back_to_menu")]]
+        lines.append(f"Особая {s.emoji or '🔀'} - {', '.join(status)}")
+    keyboard = [
+        *page_buttons("button_status", pairs, "number", has_prev, has_next),
+        [InlineKeyboardButton("Назад", callback_data="back_to_menu")],
+    ]
     await context.bot.send_message(
-        tg_id, "\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard)
+        tg_id,
+        "\n".join(lines) or "Нет кнопок.",
+        reply_markup=InlineKeyboardMarkup(keyboard),
     )
 
 
@@ -147,19 +171,17 @@ async def shuffle_pairs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await query.answer()
     await query.message.delete()
     tg_id = query.from_user.id
-    game = get_game()
-    if not is_admin(game, tg_id):
+    room = get_room()
+    if not is_admin(room.game, tg_id):
         return
-    pairs = list(buttons.find({"special": False}).sort("number", 1))
-    circles = [p["circle"] for p in pairs]
-    random.shuffle(circles)
-    for p, circle in zip(pairs, circles):
-        buttons.update_one({"_id": p["_id"]}, {"$set": {"circle": circle}})
-    pairs = list(buttons.find({"special": False}).sort("number", 1))
+    room.shuffle_pairs()
+    dashboard.schedule_refresh(context)
+    pairs, has_prev, has_next = page(room.buttons.values(), "number", [])
     text = "Пары перемешаны:\n" + "\n".join(
-        f"{number_to_square(p['number'])} - {p['circle']}" for p in pairs
+        f"{number_to_square(p.number)} - {p.circle}" for p in pairs
     )
     keyboard = [
+        *page_buttons("show_pairs", pairs, "number", has_prev, has_next),
         [InlineKeyboardButton("Перемешать пары", callback_data="shuffle_pairs")],
         [InlineKeyboardButton("Назад", callback_data="back_to_menu")],
     ]
@@ -173,52 +195,28 @@ async def start_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     await query.answer()
     await query.message.delete()
     tg_id = query.from_user.id
-    game = get_game()
-    if not is_admin(game, tg_id):
+    room = get_room()
+    if not is_admin(room.game, tg_id):
         return
-    if game.get("status") != "waiting":
+    user = room.player(tg_id)
+    outcome = room.start()
+    if outcome == engine.ALREADY_RUNNING:
         await context.bot.send_message(tg_id, "Игра уже началась.")
-        user = users.find_one({"telegram_id": tg_id})
-        await send_menu(tg_id, user, game, context)
+        await send_menu(tg_id, user, room.game, context)
         return
-    players = list(users.find({"telegram_id": {"$nin": game.get("admin_ids", [])}}))
-    player_buttons = list(
-        buttons.find({"special": False, "player_id": {"$ne": None}})
-    )
-    codes = game.get("codes", [])
-    if len(codes) < len(player_buttons):
+    if outcome == engine.NOT_ENOUGH_CODES:
         await context.bot.send_message(tg_id, "Недостаточно кодов для всех игроков.")
-        user = users.find_one({"telegram_id": tg_id})
-        await send_menu(tg_id, user, game, context)
+        await send_menu(tg_id, user, room.game, context)
         return
-    random.shuffle(codes)
-    assigned = codes[: len(player_buttons)]
-    for btn, code in zip(player_buttons, assigned):
-        buttons.update_one(
-            {"_id": btn["_id"]},
-            {"$set": {"code": code, "code_used": False}}
-        )
-    remaining = codes[len(player_buttons) :]
-    games.update_one(
-        {"_id": game["_id"]},
-        {
-            "$set": {
-                "status": "running",
-                "started_at": datetime.utcnow(),
-                "ended_at": None,
-                "codes": remaining,
-            }
-        },
-    )
-    users.update_many({}, {"$set": {"discovered_opponent_ids": [], "special_button_ids": []}})
-    for u in users.find({}):
+    room.set_game(stats_id=open_stats(room))
+    dashboard.schedule_refresh(context)
+    for u in list(room.players.values()):
         await context.bot.send_message(
-            u["telegram_id"],
-            "Игра началась! Нажмите \"Начать\", чтобы открыть меню.",
+            u.telegram_id,
+            'Игра началась! Нажмите "Начать", чтобы открыть меню.',
             reply_markup=START_KEYBOARD,
         )
-    user = users.find_one({"telegram_id": tg_id})
-    await send_menu(tg_id, user, get_game(), context)
+    await send_menu(tg_id, user, room.game, context)
 
 
 async def end_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -226,70 +224,139 @@ async def end_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await query.answer()
     await query.message.delete()
     tg_id = query.from_user.id
-    game = get_game()
-    if not is_admin(game, tg_id):
+    room = get_room()
+    if not is_admin(room.game, tg_id):
         return
-    if game.get("status") != "running":
+    if not room.running:
         await context.bot.send_message(tg_id, "Игра не запущена.")
-        user = users.find_one({"telegram_id": tg_id})
-        await send_menu(tg_id, user, game, context)
+        await send_menu(tg_id, room.player(tg_id), room.game, context)
         return
     # Notify all connected players about game end before resetting
-    players = list(
-        users.find({"telegram_id": {"$nin": game.get("admin_ids", [])}})
+    for p in room.non_admins():
+        notify(room, p.telegram_id, "Игра завершена.")
+    close_stats(room)
+    room.end(ADMIN_IDS)
+    save()
+    dashboard.schedule_refresh(context)
+    await context.bot.send_message(tg_id, "Игра завершена.")
+    await send_menu(tg_id, room.player(tg_id), room.game, context)
+
+
+async def purge_generations(context: ContextTypes.DEFAULT_TYPE) -> None:
+    cutoff = datetime.utcnow() - timedelta(days=GENERATION_TTL_DAYS)
+    for g in generations.find({"archived_at": {"$lt": cutoff}}):
+        users.delete_many({"generation": g["_id"]})
+        buttons.delete_many({"generation": g["_id"]})
+        if g.get("stats_id"):
+            stats.delete_one({"_id": g["stats_id"]})
+        generations.delete_one({"_id": g["_id"]})
+
+
+async def live_dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    await query.message.delete()
+    tg_id = query.from_user.id
+    game = get_game()
+    if not is_admin(game, tg_id):
+        return
+    if not await dashboard.toggle(tg_id, context):
+        await context.bot.send_message(tg_id, "Живая панель отключена.")
+    room = get_room()
+    await send_menu(tg_id, room.player(tg_id), room.game, context)
+
+
+async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    await query.message.delete()
+    tg_id = query.from_user.id
+    game = get_game()
+    if not is_admin(game, tg_id):
+        return
+    keyboard = [[InlineKeyboardButton("Назад", callback_data="back_to_menu")]]
+    await context.bot.send_message(
+        tg_id,
+        leaderboard_text(get_room()),
+        reply_markup=InlineKeyboardMarkup(keyboard),
     )
-    for p in players:
-        await context.bot.send_message(p["telegram_id"], "Игра завершена.")
-    games.update_one(
-        {"_id": game["_id"]},
-        {
-            "$set": {
-                "status": "waiting",
-                "started_at": None,
-                "ended_at": None,
-                "codes": [],
-            }
-        },
+
+
+def _profiling_notifier(tg_id: int, context: ContextTypes.DEFAULT_TYPE):
+    def notify(path: str, updates: int) -> None:
+        context.application.create_task(
+            context.bot.send_message(
+                tg_id, f"Профилирование завершено ({updates} обновлений): {path}"
+            )
+        )
+
+    return notify
+
+
+async def toggle_profiling(
+    tg_id: int, context: ContextTypes.DEFAULT_TYPE, updates: int, seconds: int
+) -> None:
+    if profiling.is_running():
+        profiling.stop()
+        return
+    profiling.start(
+        context.application, updates, seconds, _profiling_notifier(tg_id, context)
     )
-    users.delete_many({"telegram_id": {"$nin": ADMIN_IDS}})
-    users.update_many(
-        {"telegram_id": {"$in": ADMIN_IDS}},
-        {
-            "$set": {
-                "alive": True,
-                "kicked_by": None,
-                "discovered_opponent_ids": [],
-                "special_button_ids": [],
-                "isAdmin": True,
-            }
-        },
+    await context.bot.send_message(
+        tg_id,
+        f"Профилирование включено: {updates} обновлений или {seconds} с.",
     )
-    buttons.update_many(
-        {"special": False},
-        {
-            "$set": {
-                "taken": False,
-                "blocked": False,
-                "code": None,
-                "player_id": None,
-                "code_used": False,
-            }
-        },
+
+
+async def profile_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    await query.message.delete()
+    tg_id = query.from_user.id
+    game = get_game()
+    if not is_admin(game, tg_id):
+        return
+    await toggle_profiling(
+        tg_id, context, profiling.DEFAULT_UPDATES, profiling.DEFAULT_SECONDS
     )
-    buttons.delete_many({"special": True})
-    await context.bot.send_message(tg_id, "Игра завершена.")
-    user = users.find_one({"telegram_id": tg_id})
-    await send_menu(tg_id, user, get_game(), context)
+    await send_menu(tg_id, get_room().player(tg_id), game, context)
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tg_id = update.effective_user.id
+    game = get_game()
+    if not is_admin(game, tg_id):
+        return
+    # /profile [N] [Ts] — stop after N updates or T seconds, whichever comes first
+    updates, seconds = profiling.DEFAULT_UPDATES, profiling.DEFAULT_SECONDS
+    for arg in context.args:
+        if arg.endswith("s") and arg[:-1].isdigit():
+            seconds = int(arg[:-1])
+        elif arg.isdigit():
+            updates = int(arg)
+    await toggle_profiling(tg_id, context, updates, seconds)
+
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    tg_id = update.effective_user.id
+    game = get_game()
+    if not is_admin(game, tg_id):
+        return
+    await update.message.reply_text(metrics.summary())
 
 
 def register_admin_handlers(application):
-    application.add_handler(CallbackQueryHandler(start_game, pattern="^start_game$"))
-    application.add_handler(CallbackQueryHandler(end_game, pattern="^end_game$"))
-    application.add_handler(CallbackQueryHandler(add_codes, pattern="^add_codes$"))
-    application.add_handler(CallbackQueryHandler(add_special, pattern="^add_special$"))
-    application.add_handler(CallbackQueryHandler(player_list, pattern="^player_list$"))
-    application.add_handler(CallbackQueryHandler(show_pairs, pattern="^show_pairs$"))
-    application.add_handler(CallbackQueryHandler(shuffle_pairs, pattern="^shuffle_pairs$"))
-    application.add_handler(
-        CallbackQueryHandler(button_status, pattern="^button_status$")
-    )
+    register("start_game", start_game)
+    register("end_game", end_game)
+    register("add_codes", add_codes)
+    register("add_special", add_special)
+    register("player_list", player_list)
+    register("show_pairs", show_pairs)
+    register("shuffle_pairs", shuffle_pairs)
+    register("button_status", button_status)
+    register("leaderboard", leaderboard)
+    register("dashboard", live_dashboard)
+    register("profile", profile_button)
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("metrics", metrics_command))
+    application.job_queue.run_repeating(purge_generations, interval=3600, first=60)
@@ -0,0 +1,107 @@
+from typing import Dict
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import ContextTypes
+
+import metrics
+from engine import Room
+from utils import get_name, get_room, number_to_square
+
+# Changes are collected for this many seconds before the dashboards are edited
+DEBOUNCE_SECONDS = 2.0
+
+# admin id -> text currently shown in their dashboard message
+last_text: Dict[int, str] = {}
+pending = {"job": None}
+
+
+def render(room: Room) -> str:
+    lines = [f"Игра: {'идет' if room.running else 'ожидание'}"]
+    for b in sorted(room.buttons.values(), key=lambda b: b.number):
+        player = room.by_id.get(b.player_id)
+        if not player or player.is_admin or player.number is None:
+            continue
+        if not player.alive or b.blocked:
+            status = "заблокирована 🚫"
+        elif b.code_used:
+            status = "на руках ✋"
+        else:
+            status = "в игре ⛳"
+        lines.append(
+            f"{number_to_square(player.number)}{b.circle} "
+            f"{get_name(player)} {b.code or '-'} {status}"
+        )
+    for s in sorted(room.specials.values(), key=lambda s: s.slot):
+        if s.blocked:
+            status = "заблокирована 🚫"
+        elif s.taken:
+            status = "у игрока 👤"
+        else:
+            status = "в игре ⛳"
+        lines.append(f"Особая {s.emoji or '🔀'} {status}")
+    return "\n".join(lines)
+
+
+async def toggle(tg_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    room = get_room()
+    message_id = room.game.get("dashboards", {}).get(str(tg_id))
+    if message_id:
+        room.set_dashboard(tg_id, None)
+        last_text.pop(tg_id, None)
+        try:
+            await context.bot.unpin_chat_message(tg_id, message_id)
+        except BadRequest:
+            pass
+        return False
+    text = render(room)
+    message = await context.bot.send_message(tg_id, text)
+    await context.bot.pin_chat_message(
+        tg_id, message.message_id, disable_notification=True
+    )
+    room.set_dashboard(tg_id, message.message_id)
+    last_text[tg_id] = text
+    return True
+
+
+def schedule_refresh(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Several changes inside the debounce window end up in a single edit
+    if pending["job"] is not None:
+        metrics.incr("dashboard_coalesced")
+        return
+    pending["job"] = context.job_queue.run_once(refresh, DEBOUNCE_SECONDS)
+
+
+async def refresh(context: ContextTypes.DEFAULT_TYPE) -> None:
+    pending["job"] = None
+    room = get_room()
+    dashboards = room.game.get("dashboards", {})
+    if not dashboards:
+        return
+    text = render(room)
+    # Seconds until the admins whose edit failed are tried again
+    retry = 0.0
+    for admin_id, message_id in list(dashboards.items()):
+        admin_id = int(admin_id)
+        if last_text.get(admin_id) == text:
+            metrics.incr("dashboard_unchanged")
+            continue
+        try:
+            await context.bot.edit_message_text(text, admin_id, message_id)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                # The message is gone; stop tracking it until the admin reopens it
+                room.set_dashboard(admin_id, None)
+                continue
+        except RetryAfter as e:
+            metrics.incr("dashboard_edit_errors")
+            retry = max(retry, e.retry_after)
+            continue
+        except TelegramError:
+            # Network trouble with one admin must not leave the others stale
+            metrics.incr("dashboard_edit_errors")
+            retry = max(retry, DEBOUNCE_SECONDS)
+            continue
+        last_text[admin_id] = text
+        metrics.incr("dashboard_edits")
+    if retry and pending["job"] is None:
+        pending["job"] = context.job_queue.run_once(refresh, retry)
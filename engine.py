@@ -0,0 +1,547 @@
+import random
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+
+# Game rules for one room, kept in memory. Every mutation updates the objects
+# here and appends the matching write to `pending`; the bot flushes it to
+# MongoDB in order (write-behind). Nothing in this module talks to the database.
+
+CIRCLE_EMOJIS = ["🔴", "🟠", "🟡", "🟢", "🔵", "🟣", "🟤", "⚫", "⚪"]
+MAX_PLAYERS = 9
+SPECIAL_EMOJI = "\U0001f500"
+
+# Outcomes returned to handlers
+JOINED = "joined"
+EXISTING = "existing"
+ALREADY_RUNNING = "running"
+FULL = "full"
+FOUND = "found"
+FOUND_SPECIAL = "special"
+ALREADY_FOUND = "already"
+BLOCKED = "blocked"
+UNKNOWN = "unknown"
+NOT_ENOUGH_CODES = "codes"
+STARTED = "started"
+NOT_RUNNING = "not_running"
+OUT = "out"
+UNAVAILABLE = "unavailable"
+KICKED = "kicked"
+SWITCHED = "switched"
+
+
+class Player:
+    __slots__ = (
+        "id",
+        "telegram_id",
+        "username",
+        "first_name",
+        "last_name",
+        "alive",
+        "discovered",
+        "specials",
+        "is_admin",
+        "number",
+        "kicked_by",
+    )
+
+    def __init__(
+        self,
+        telegram_id: int,
+        username: Optional[str] = None,
+        first_name: Optional[str] = None,
+        last_name: Optional[str] = None,
+        is_admin: bool = False,
+        number: Optional[int] = None,
+        id: Optional[ObjectId] = None,
+    ) -> None:
+        self.id = id or ObjectId()
+        self.telegram_id = telegram_id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+        self.alive = True
+        self.discovered: List[ObjectId] = []
+        self.specials: List[ObjectId] = []
+        self.is_admin = is_admin
+        self.number = number
+        self.kicked_by: Optional[ObjectId] = None
+
+    @classmethod
+    def from_doc(cls, doc: Dict) -> "Player":
+        p = cls(
+            doc["telegram_id"],
+            doc.get("username"),
+            doc.get("first_name"),
+            doc.get("last_name"),
+            bool(doc.get("isAdmin")),
+            doc.get("number"),
+            doc["_id"],
+        )
+        p.alive = doc.get("alive", True)
+        p.discovered = list(doc.get("discovered_opponent_ids", []))
+        p.specials = list(doc.get("special_button_ids", []))
+        p.kicked_by = doc.get("kicked_by")
+        return p
+
+    def to_doc(self, generation: int) -> Dict:
+        return {
+            "_id": self.id,
+            "generation": generation,
+            "telegram_id": self.telegram_id,
+            "username": self.username,
+            "first_name": self.first_name,
+            "last_name": self.last_name,
+            "alive": self.alive,
+            "discovered_opponent_ids": list(self.discovered),
+            "special_button_ids": list(self.specials),
+            "isAdmin": self.is_admin,
+            "number": self.number,
+            "kicked_by": self.kicked_by,
+        }
+
+
+class Button:
+    __slots__ = (
+        "id",
+        "number",
+        "circle",
+        "taken",
+        "blocked",
+        "code",
+        "player_id",
+        "code_used",
+        "special",
+        "slot",
+        "emoji",
+    )
+
+    def __init__(
+        self,
+        number: Optional[int] = None,
+        circle: Optional[str] = None,
+        special: bool = False,
+        code: Optional[str] = None,
+        slot: Optional[int] = None,
+        emoji: Optional[str] = None,
+        id: Optional[ObjectId] = None,
+    ) -> None:
+        self.id = id or ObjectId()
+        self.number = number
+        self.circle = circle
+        self.taken = False
+        self.blocked = False
+        self.code = code
+        self.player_id: Optional[ObjectId] = None
+        self.code_used = False
+        self.special = special
+        self.slot = slot
+        self.emoji = emoji
+
+    @classmethod
+    def from_doc(cls, doc: Dict) -> "Button":
+        b = cls(
+            doc.get("number"),
+            doc.get("circle"),
+            bool(doc.get("special")),
+            doc.get("code"),
+            doc.get("slot"),
+            doc.get("emoji"),
+            doc["_id"],
+        )
+        b.taken = doc.get("taken", False)
+        b.blocked = doc.get("blocked", False)
+        b.player_id = doc.get("player_id")
+        b.code_used = doc.get("code_used", False)
+        return b
+
+    def to_doc(self, generation: int) -> Dict:
+        doc = {
+            "_id": self.id,
+            "generation": generation,
+            "taken": self.taken,
+            "blocked": self.blocked,
+            "code": self.code,
+            "code_used": self.code_used,
+            "special": self.special,
+        }
+        if self.special:
+            doc.update(slot=self.slot, emoji=self.emoji)
+        else:
+            doc.update(number=self.number, circle=self.circle, player_id=self.player_id)
+        return doc
+
+
+class Room:
+    __slots__ = ("game", "players", "by_id", "buttons", "specials", "codes", "pending")
+
+    def __init__(self, game: Dict) -> None:
+        self.game = game
+        self.players: Dict[int, Player] = {}
+        self.by_id: Dict[ObjectId, Player] = {}
+        # standard buttons by number, special buttons by slot
+        self.buttons: Dict[int, Button] = {}
+        self.specials: Dict[int, Button] = {}
+        self.codes: Dict[str, Button] = {}
+        self.pending: List[Tuple[str, object]] = []
+
+    @classmethod
+    def load(
+        cls, game: Dict, players: Iterable[Dict], buttons: Iterable[Dict]
+    ) -> "Room":
+        room = cls(game)
+        for doc in players:
+            room._add_player(Player.from_doc(doc))
+        for doc in buttons:
+            room._add_button(Button.from_doc(doc))
+        if not room.buttons:
+            room._create_buttons()
+        return room
+
+    @property
+    def generation(self) -> int:
+        return self.game.get("generation", 0)
+
+    @property
+    def running(self) -> bool:
+        return self.game.get("status") == "running"
+
+    def is_admin(self, tg_id: int) -> bool:
+        return tg_id in self.game.get("admin_ids", [])
+
+    # -- write-behind -------------------------------------------------------
+
+    def queue(self, collection: str, op) -> None:
+        self.pending.append((collection, op))
+
+    def take_pending(self) -> List[Tuple[str, object]]:
+        pending, self.pending = self.pending, []
+        return pending
+
+    def _save_player(self, p: Player, **fields) -> None:
+        self.queue("users", UpdateOne({"_id": p.id}, {"$set": fields}))
+
+    def _save_button(self, b: Button, **fields) -> None:
+        self.queue("buttons", UpdateOne({"_id": b.id}, {"$set": fields}))
+
+    def set_game(self, **fields) -> None:
+        self.game.update(fields)
+        self.queue("games", UpdateOne({"_id": self.game["_id"]}, {"$set": fields}))
+
+    def set_dashboard(self, tg_id: int, message_id: Optional[int]) -> None:
+        dashboards = self.game.setdefault("dashboards", {})
+        key = f"dashboards.{tg_id}"
+        if message_id is None:
+            dashboards.pop(str(tg_id), None)
+            update = {"$unset": {key: ""}}
+        else:
+            dashboards[str(tg_id)] = message_id
+            update = {"$set": {key: message_id}}
+        self.queue("games", UpdateOne({"_id": self.game["_id"]}, update))
+
+    def _bump_version(self) -> None:
+        self.set_game(version=self.game.get("version", 0) + 1)
+
+    # -- lookups ------------------------------------------------------------
+
+    def _add_player(self, p: Player) -> None:
+        self.players[p.telegram_id] = p
+        self.by_id[p.id] = p
+
+    def _add_button(self, b: Button) -> None:
+        if b.special:
+            self.specials[b.slot] = b
+        else:
+            self.buttons[b.number] = b
+        if b.code:
+            self.codes[b.code] = b
+
+    def player(self, tg_id: int) -> Optional[Player]:
+        return self.players.get(tg_id)
+
+    def player_by_number(self, number: int) -> Optional[Player]:
+        for p in self.players.values():
+            if p.number == number and not p.is_admin:
+                return p
+        return None
+
+    def non_admins(self) -> List[Player]:
+        return sorted(
+            (p for p in self.players.values() if not self.is_admin(p.telegram_id)),
+            key=lambda p: p.number or 0,
+        )
+
+    def circle(self, number: Optional[int]) -> str:
+        b = self.buttons.get(number)
+        return b.circle if b else ""
+
+    def own_button(self, p: Player) -> Optional[Button]:
+        for b in self.buttons.values():
+            if b.player_id == p.id:
+                return b
+        return None
+
+    def is_known(self, code: str) -> bool:
+        # Codes that can give an answer other than "not found"
+        b = self.codes.get(code)
+        return b is not None and not (b.special and (b.blocked or b.taken))
+
+    # -- rules --------------------------------------------------------------
+
+    def _create_buttons(self) -> None:
+        for i, circle in enumerate(CIRCLE_EMOJIS, start=1):
+            b = Button(i, circle)
+            self._add_button(b)
+            self.queue("buttons", InsertOne(b.to_doc(self.generation)))
+
+    def join(
+        self,
+        tg_id: int,
+        username: Optional[str],
+        first_name: Optional[str],
+        last_name: Optional[str],
+    ) -> Tuple[str, Optional[Player]]:
+        p = self.players.get(tg_id)
+        if p:
+            return EXISTING, p
+        admin = self.is_admin(tg_id)
+        if self.running and not admin:
+            return ALREADY_RUNNING, None
+        number = None
+        if not admin:
+            count = sum(1 for p in self.players.values() if not p.is_admin)
+            if count >= MAX_PLAYERS:
+                return FULL, None
+            number = count + 1
+        p = Player(tg_id, username, first_name, last_name, admin, number)
+        self._add_player(p)
+        self.queue("users", InsertOne(p.to_doc(self.generation)))
+        if not admin:
+            b = self.buttons[number]
+            b.taken, b.blocked, b.player_id, b.code_used = True, False, p.id, False
+            self._save_button(
+                b, taken=True, blocked=False, player_id=p.id, code_used=False
+            )
+        return JOINED, p
+
+    def _code_taken(self, code: str) -> bool:
+        return code in self.codes or code in self.game.get("codes", [])
+
+    def add_codes(self, codes: List[str]) -> List[str]:
+        # Returns the codes that were added; ones already in the pool or used by
+        # a button are skipped, since codes are unique within a game run
+        added = []
+        for code in codes:
+            if not self._code_taken(code) and code not in added:
+                added.append(code)
+        if not added:
+            return added
+        self.game.setdefault("codes", []).extend(added)
+        self.queue(
+            "games",
+            UpdateOne(
+                {"_id": self.game["_id"]},
+                {"$push": {"codes": {"$each": added}}},
+            ),
+        )
+        return added
+
+    def add_special(self, code: str) -> bool:
+        if self._code_taken(code):
+            return False
+        b = Button(
+            special=True, code=code, slot=len(self.specials) + 1, emoji=SPECIAL_EMOJI
+        )
+        self._add_button(b)
+        self.queue("buttons", InsertOne(b.to_doc(self.generation)))
+        return True
+
+    def redeem(self, p: Player, code: str) -> Tuple[str, object]:
+        b = self.codes.get(code)
+        if b is None:
+            return UNKNOWN, None
+        if b.special:
+            if b.blocked or b.taken:
+                return UNKNOWN, None
+            b.taken = True
+            self._save_button(b, taken=True)
+            p.specials.append(b.id)
+            self.queue(
+                "users",
+                UpdateOne({"_id": p.id}, {"$addToSet": {"special_button_ids": b.id}}),
+            )
+            return FOUND_SPECIAL, b
+        if b.blocked:
+            return BLOCKED, None
+        if b.code_used:
+            return UNKNOWN, None
+        opponent = self.by_id.get(b.player_id)
+        if not opponent or not opponent.alive:
+            return UNKNOWN, None
+        if opponent.id in p.discovered:
+            return ALREADY_FOUND, opponent
+        b.code_used = True
+        self._save_button(b, code_used=True)
+        self._discover(p, opponent.id)
+        return FOUND, opponent
+
+    def _discover(self, p: Player, opponent_id: ObjectId) -> None:
+        if opponent_id in p.discovered:
+            return
+        p.discovered.append(opponent_id)
+        self.queue(
+            "users",
+            UpdateOne(
+                {"_id": p.id}, {"$addToSet": {"discovered_opponent_ids": opponent_id}}
+            ),
+        )
+
+    def _check(self, p: Player) -> Optional[str]:
+        # Why a player cannot act right now, if they cannot
+        if not self.running:
+            return NOT_RUNNING
+        if not p.alive:
+            return OUT
+        return None
+
+    def kick(
+        self, p: Player, opponent: Player
+    ) -> Tuple[str, List[Tuple[Player, Player]]]:
+        # Returns the outcome and, for KICKED, the inherited buttons as
+        # (recipient, button owner) pairs
+        refused = self._check(p)
+        if refused:
+            return refused, []
+        if not opponent.alive or opponent.id not in p.discovered:
+            return UNAVAILABLE, []
+        opponent.alive = False
+        opponent.kicked_by = p.id
+        self._save_player(opponent, alive=False, kicked_by=p.id)
+        b = self.own_button(opponent)
+        if b:
+            b.blocked = True
+            self._save_button(b, blocked=True)
+        inherited = []
+        if opponent is p:
+            # Pressing your own button hands what you found to the others
+            available = [oid for oid in p.discovered if oid != p.id]
+            alive = [
+                o
+                for o in self.players.values()
+                if o.alive and o is not p and not o.is_admin
+            ]
+            if available and alive:
+                random.shuffle(alive)
+                for i, oid in enumerate(available):
+                    recipient = alive[i % len(alive)]
+                    self._discover(recipient, oid)
+                    if oid in self.by_id:
+                        inherited.append((recipient, self.by_id[oid]))
+        else:
+            for oid in opponent.discovered:
+                if oid == opponent.id:
+                    continue
+                self._discover(p, oid)
+                if oid in self.by_id:
+                    inherited.append((p, self.by_id[oid]))
+        return KICKED, inherited
+
+    def eliminated(self) -> int:
+        return sum(1 for p in self.players.values() if not p.is_admin and not p.alive)
+
+    def use_special(self, p: Player, special: Button) -> str:
+        refused = self._check(p)
+        if refused:
+            return refused
+        if special.id not in p.specials or special.blocked:
+            return UNAVAILABLE
+        active = [
+            b
+            for b in self.buttons.values()
+            if b.player_id is not None and not b.blocked
+        ]
+        triples = [(b.number, b.circle, b.player_id) for b in active]
+        random.shuffle(triples)
+        for b, (n, c, pid) in zip(active, triples):
+            b.number, b.circle, b.player_id = n, c, pid
+            self._save_button(b, number=n, circle=c, player_id=pid)
+        self.buttons = {b.number: b for b in self.buttons.values()}
+        special.code_used = special.blocked = special.taken = True
+        self._save_button(special, code_used=True, blocked=True, taken=True)
+        p.specials.remove(special.id)
+        self.queue(
+            "users",
+            UpdateOne({"_id": p.id}, {"$pull": {"special_button_ids": special.id}}),
+        )
+        self._bump_version()
+        return SWITCHED
+
+    def shuffle_pairs(self) -> None:
+        pairs = sorted(self.buttons.values(), key=lambda b: b.number)
+        circles = [b.circle for b in pairs]
+        random.shuffle(circles)
+        for b, circle in zip(pairs, circles):
+            b.circle = circle
+            self._save_button(b, circle=circle)
+        self._bump_version()
+
+    def start(self) -> str:
+        if self.game.get("status") != "waiting":
+            return ALREADY_RUNNING
+        player_buttons = [b for b in self.buttons.values() if b.player_id is not None]
+        codes = list(self.game.get("codes", []))
+        if len(codes) < len(player_buttons):
+            return NOT_ENOUGH_CODES
+        random.shuffle(codes)
+        for b, code in zip(player_buttons, codes):
+            self.codes.pop(b.code, None)
+            b.code, b.code_used = code, False
+            self.codes[code] = b
+            self._save_button(b, code=code, code_used=False)
+        for p in self.players.values():
+            p.discovered, p.specials = [], []
+            self._save_player(p, discovered_opponent_ids=[], special_button_ids=[])
+        self.set_game(
+            status="running",
+            started_at=datetime.utcnow(),
+            ended_at=None,
+            codes=codes[len(player_buttons) :],
+        )
+        return STARTED
+
+    def end(self, admin_ids: List[int]) -> None:
+        # The finished run is archived as is and the room moves to a fresh
+        # generation, so the reset costs the same however big the game was
+        generation = self.generation
+        self.queue(
+            "generations",
+            UpdateOne(
+                {"_id": generation},
+                {
+                    "$set": {
+                        "started_at": self.game.get("started_at"),
+                        "archived_at": datetime.utcnow(),
+                        "stats_id": self.game.get("stats_id"),
+                    }
+                },
+                upsert=True,
+            ),
+        )
+        admins = [p for p in self.players.values() if p.telegram_id in admin_ids]
+        self.players, self.by_id = {}, {}
+        self.buttons, self.specials, self.codes = {}, {}, {}
+        self.set_game(
+            status="waiting",
+            started_at=None,
+            ended_at=None,
+            codes=[],
+            generation=generation + 1,
+            version=self.game.get("version", 0) + 1,
+        )
+        for a in admins:
+            p = Player(a.telegram_id, a.username, a.first_name, a.last_name, True)
+            self._add_player(p)
+            self.queue("users", InsertOne(p.to_doc(self.generation)))
+        self._create_buttons()
@@ -0,0 +1,23 @@
+import time
+from typing import Dict, Tuple
+
+import metrics
+
+# Each player can guess GUESS_BURST codes in a row, then one every GUESS_REFILL_SECONDS
+GUESS_BURST = 5
+GUESS_REFILL_SECONDS = 3.0
+
+# telegram id -> (tokens, last refill time)
+buckets: Dict[int, Tuple[float, float]] = {}
+
+
+def allow_guess(tg_id: int) -> bool:
+    now = time.monotonic()
+    tokens, last = buckets.get(tg_id, (GUESS_BURST, now))
+    tokens = min(GUESS_BURST, tokens + (now - last) / GUESS_REFILL_SECONDS)
+    if tokens < 1:
+        buckets[tg_id] = (tokens, now)
+        metrics.incr("code_guesses_throttled")
+        return False
+    buckets[tg_id] = (tokens - 1, now)
+    return True
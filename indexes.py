@@ -0,0 +1,70 @@
+from typing import Dict, List, Tuple
+
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+# Index catalogue: every query shape in bot.py, admin.py, utils.py and the helper
+# modules is served by one of these. tests/test_query_plans.py lists the shapes and
+# checks their plans, so a new query should come with an entry there and, if
+# needed, here.
+# Game state is read once per run (engine.Room) and written by _id, so besides the
+# uniqueness guarantees only loading a run and purging old ones need an index.
+INDEXES: Dict[str, List[Tuple[List[Tuple[str, int]], Dict]]] = {
+    "users": [
+        # One player document per Telegram id in a game run; also loads a run
+        ([("generation", 1), ("telegram_id", 1)], {"unique": True}),
+    ],
+    "buttons": [
+        # Buttons are unique by code within a game run when code is assigned;
+        # "$gt": "" keeps unassigned (null) codes out and lets equality lookups use it
+        (
+            [("generation", 1), ("code", 1)],
+            {"unique": True, "partialFilterExpression": {"code": {"$gt": ""}}},
+        ),
+        # Loads and purges a run
+        ([("generation", 1), ("special", 1), ("number", 1)], {}),
+    ],
+    "generations": [
+        ([("archived_at", 1)], {}),
+    ],
+    "outbox": [
+        # Claiming the next due message
+        ([("status", 1), ("due_at", 1)], {}),
+        # Delivered and abandoned messages are dropped a day after they are done
+        ([("done_at", 1)], {"expireAfterSeconds": 24 * 3600}),
+    ],
+}
+
+# Old single-field unique indexes, replaced by the per-generation ones above
+OBSOLETE_INDEXES = {"users": ["telegram_id_1"], "buttons": ["code_1"]}
+
+INDEX_NOT_FOUND = 27
+INDEX_OPTIONS_CONFLICT = 85
+INDEX_KEY_SPECS_CONFLICT = 86
+
+
+def _drop_index(collection, index) -> None:
+    # Another process starting at the same time may have dropped it already
+    try:
+        collection.drop_index(index)
+    except OperationFailure as e:
+        if e.code != INDEX_NOT_FOUND:
+            raise
+
+
+def ensure_indexes(db: Database) -> None:
+    for name, obsolete in OBSOLETE_INDEXES.items():
+        existing = db[name].index_information()
+        for index in obsolete:
+            if index in existing:
+                _drop_index(db[name], index)
+    for name, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                db[name].create_index(keys, **options)
+            except OperationFailure as e:
+                # Same keys with changed options: rebuild the index
+                if e.code not in (INDEX_OPTIONS_CONFLICT, INDEX_KEY_SPECS_CONFLICT):
+                    raise
+                _drop_index(db[name], keys)
+                db[name].create_index(keys, **options)
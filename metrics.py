@@ -0,0 +1,14 @@
+from collections import Counter
+
+# Process-local instrumentation counters, shown to admins with /metrics
+counters: Counter = Counter()
+
+
+def incr(name: str, value: int = 1) -> None:
+    counters[name] += value
+
+
+def summary() -> str:
+    if not counters:
+        return "Счетчиков пока нет."
+    return "\n".join(f"{name}: {value}" for name, value in sorted(counters.items()))
@@ -0,0 +1,131 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from bson import ObjectId
+from pymongo import InsertOne, ReturnDocument
+from pymongo.errors import PyMongoError
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.ext import ContextTypes
+
+import metrics
+from engine import Room
+from storage import outbox
+from utils import flush_room
+
+# Side messages (join notices, kicks, inheritance) are not sent by the handler.
+# They are queued on the room next to the state change that caused them, reach
+# the outbox collection in the same flush, and are delivered from here. A record
+# is claimed by pushing its due_at past a lease; if the process dies before it is
+# marked sent, the lease runs out and the message goes again (at least once).
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_INTERVAL = 1.0
+LEASE_SECONDS = 30
+# Records sent per run; Telegram allows about 30 messages a second
+BATCH = 25
+MAX_ATTEMPTS = 8
+MAX_BACKOFF_SECONDS = 300
+
+
+def notify(room: Room, chat_id: int, text: str) -> None:
+    now = datetime.utcnow()
+    room.queue(
+        "outbox",
+        InsertOne(
+            {
+                "_id": ObjectId(),
+                "chat_id": chat_id,
+                "text": text,
+                "status": "pending",
+                "attempts": 0,
+                "due_at": now,
+                "created_at": now,
+            }
+        ),
+    )
+
+
+def _claim() -> Optional[Dict]:
+    now = datetime.utcnow()
+    return outbox.find_one_and_update(
+        {"status": "pending", "due_at": {"$lte": now}},
+        {
+            "$set": {"due_at": now + timedelta(seconds=LEASE_SECONDS)},
+            "$inc": {"attempts": 1},
+        },
+        sort=[("due_at", 1), ("_id", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def _finish(record: Dict, status: str, error: Optional[str] = None) -> None:
+    outbox.update_one(
+        {"_id": record["_id"]},
+        {"$set": {"status": status, "done_at": datetime.utcnow(), "error": error}},
+    )
+
+
+def _retry(record: Dict, seconds: float, error: str) -> None:
+    if record["attempts"] >= MAX_ATTEMPTS:
+        metrics.incr("outbox_failed")
+        _finish(record, "failed", error)
+        return
+    metrics.incr("outbox_retried")
+    outbox.update_one(
+        {"_id": record["_id"]},
+        {
+            "$set": {
+                "due_at": datetime.utcnow() + timedelta(seconds=seconds),
+                "error": error,
+            }
+        },
+    )
+
+
+def _postpone(record: Dict, seconds: float) -> None:
+    # Flood control is not a failed send: the claim's attempt is given back, so
+    # MAX_ATTEMPTS only counts real send errors
+    metrics.incr("outbox_throttled")
+    outbox.update_one(
+        {"_id": record["_id"]},
+        {
+            "$set": {"due_at": datetime.utcnow() + timedelta(seconds=seconds)},
+            "$inc": {"attempts": -1},
+        },
+    )
+
+
+def save() -> None:
+    # Handlers call this once their notices are queued, so the notices are on
+    # disk before the handler returns rather than at the next periodic flush
+    try:
+        flush_room()
+    except PyMongoError:
+        logger.exception("Flush failed; notices stay queued for the next one")
+
+
+async def dispatch(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Records queued since the last flush should not wait for the next one; a
+    # failed flush must not hold back the records that are already saved
+    save()
+    for _ in range(BATCH):
+        record = _claim()
+        if record is None:
+            return
+        try:
+            await context.bot.send_message(record["chat_id"], record["text"])
+        except RetryAfter as e:
+            _postpone(record, e.retry_after)
+            return
+        except (Forbidden, BadRequest) as e:
+            # The player blocked the bot or the chat is gone; retrying will not help
+            metrics.incr("outbox_failed")
+            _finish(record, "failed", str(e))
+            continue
+        except TelegramError as e:
+            _retry(record, min(2 ** record["attempts"], MAX_BACKOFF_SECONDS), str(e))
+            continue
+        metrics.incr("outbox_sent")
+        _finish(record, "sent")
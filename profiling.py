@@ -0,0 +1,155 @@
+import asyncio
+import cProfile
+import os
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import router
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+DEFAULT_UPDATES = 50
+DEFAULT_SECONDS = 60
+SAMPLE_INTERVAL = 0.001
+
+
+class _Session:
+    def __init__(self, limit: int, notify: Optional[Callable]) -> None:
+        self.limit = limit
+        self.notify = notify
+        self.updates = 0
+        self.current: Optional[str] = None
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.stacks: Counter = Counter()
+        self.originals: List[Tuple[object, Callable]] = []
+        self.routes: Dict[str, Callable] = {}
+        self.stopped = threading.Event()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+# Only set while profiling is on; handlers are wrapped for that time only,
+# so there is no per-update cost when it is off.
+session: Optional[_Session] = None
+
+
+def is_running() -> bool:
+    return session is not None
+
+
+def _sample(s: _Session, thread_id: int) -> None:
+    while not s.stopped.wait(SAMPLE_INTERVAL):
+        name = s.current
+        frame = sys._current_frames().get(thread_id)
+        if name is None or frame is None:
+            continue
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+            frame = frame.f_back
+        stack.append(name)
+        s.stacks[";".join(reversed(stack))] += 1
+
+
+class _Profiled:
+    # Drives a handler coroutine one step at a time and profiles only those
+    # steps: while the handler awaits, the loop runs other updates and jobs
+    # (flushes, the outbox, dashboard refreshes), which must not be charged to it
+    def __init__(self, s: _Session, name: str, coro) -> None:
+        self.s = s
+        self.name = name
+        self.coro = coro
+
+    def __await__(self):
+        profile = self.s.profiles.setdefault(self.name, cProfile.Profile())
+        value, error = None, None
+        while True:
+            self.s.current = self.name
+            profile.enable()
+            try:
+                if error is not None:
+                    future = self.coro.throw(error)
+                else:
+                    future = self.coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                profile.disable()
+                self.s.current = None
+            try:
+                value, error = (yield future), None
+            except BaseException as e:
+                value, error = None, e
+
+
+def _wrap(s: _Session, name: str, callback: Callable) -> Callable:
+    async def wrapper(update, context):
+        try:
+            return await _Profiled(s, name, callback(update, context))
+        finally:
+            s.updates += 1
+            if s.updates >= s.limit and session is s:
+                stop()
+
+    return wrapper
+
+
+def start(
+    application,
+    updates: int = DEFAULT_UPDATES,
+    seconds: int = DEFAULT_SECONDS,
+    notify: Optional[Callable] = None,
+) -> bool:
+    global session
+    if session is not None:
+        return False
+    s = _Session(updates, notify)
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            callback = handler.callback
+            # Callback queries are profiled per route below, not as one dispatcher
+            if callback is router.dispatch:
+                continue
+            s.originals.append((handler, callback))
+            handler.callback = _wrap(s, callback.__name__, callback)
+    s.routes = dict(router.routes)
+    for action, callback in s.routes.items():
+        router.routes[action] = _wrap(s, callback.__name__, callback)
+    threading.Thread(
+        target=_sample, args=(s, threading.get_ident()), daemon=True
+    ).start()
+    s.timer = asyncio.get_running_loop().call_later(seconds, stop)
+    session = s
+    return True
+
+
+def stop() -> Optional[str]:
+    global session
+    s = session
+    if s is None:
+        return None
+    session = None
+    s.stopped.set()
+    if s.timer:
+        s.timer.cancel()
+    for handler, callback in s.originals:
+        handler.callback = callback
+    router.routes.update(s.routes)
+    path = _dump(s)
+    if s.notify:
+        s.notify(path, s.updates)
+    return path
+
+
+def _dump(s: _Session) -> str:
+    path = os.path.join(PROFILE_DIR, datetime.utcnow().strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(path, exist_ok=True)
+    for name, profile in s.profiles.items():
+        profile.dump_stats(os.path.join(path, f"{name}.prof"))
+    # Collapsed stacks, one "frame;frame;frame count" per line, for flamegraph.pl / speedscope
+    with open(os.path.join(path, "stacks.collapsed"), "w", encoding="utf-8") as f:
+        for stack, count in s.stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    return path
@@ -0,0 +1,71 @@
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, ContextTypes
+
+import metrics
+
+DUPLICATE_TTL = 3.0
+
+# callback_data is "<action>[:arg...]"; the action picks the handler from this table
+routes: Dict[str, Callable] = {}
+
+# (chat id, message id, callback data) -> time until which repeats are dropped
+recent: Dict[Tuple[int, int, str], float] = {}
+
+
+def register(action: str, callback: Callable) -> None:
+    routes[action] = callback
+
+
+def encode(action: str, *args) -> str:
+    return ":".join([action, *(str(a) for a in args)])
+
+
+def decode(data: Optional[str]) -> Tuple[str, List[str]]:
+    action, *args = (data or "").split(":")
+    return action, args
+
+
+def is_stale(version: str, current: int) -> bool:
+    # Buttons carry the game version they were rendered for; a shuffle bumps it
+    return version != str(current)
+
+
+def is_duplicate(query) -> bool:
+    now = time.monotonic()
+    if len(recent) > 1000:
+        for key in [k for k, until in recent.items() if until <= now]:
+            del recent[key]
+    message = query.message
+    key = (
+        message.chat_id if message else 0,
+        message.message_id if message else 0,
+        query.data,
+    )
+    if recent.get(key, 0) > now:
+        return True
+    recent[key] = now + DUPLICATE_TTL
+    return False
+
+
+async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    action, _ = decode(query.data)
+    callback = routes.get(action)
+    metrics.incr("callbacks")
+    if callback is None:
+        await query.answer()
+        return
+    # A double tap sends the same data from the same message twice; only the first runs
+    if is_duplicate(query):
+        metrics.incr("callbacks_deduplicated")
+        metrics.incr(f"callbacks_deduplicated.{action}")
+        await query.answer()
+        return
+    await callback(update, context)
+
+
+def callback_handler() -> CallbackQueryHandler:
+    return CallbackQueryHandler(dispatch)
@@ -0,0 +1,111 @@
+from datetime import datetime
+from typing import Dict
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+
+from engine import Player, Room
+from storage import stats
+from utils import get_name, number_to_square
+
+# One document per game run; every counter is bumped in place with $inc/$min/$set
+# at the mutation point, so reading the leaderboard is a single find_one by _id.
+# The updates are queued on the room and go out with its other writes.
+
+
+def _key(user: Player) -> str:
+    return f"players.{user.number}"
+
+
+def _tracked(room: Room, user: Player) -> bool:
+    return bool(room.game.get("stats_id")) and isinstance(user.number, int)
+
+
+def _update(room: Room, update: Dict) -> None:
+    room.queue("stats", UpdateOne({"_id": room.game["stats_id"]}, update))
+
+
+def open_stats(room: Room) -> ObjectId:
+    doc = {
+        "_id": ObjectId(),
+        "generation": room.generation,
+        "started_at": datetime.utcnow(),
+        "ended_at": None,
+        "eliminated": 0,
+        "players": {
+            str(p.number): {
+                "name": get_name(p),
+                "codes_redeemed": 0,
+                "kicks": 0,
+                "specials_used": 0,
+            }
+            for p in room.non_admins()
+            if isinstance(p.number, int)
+        },
+    }
+    room.queue("stats", InsertOne(doc))
+    return doc["_id"]
+
+
+def close_stats(room: Room) -> None:
+    if room.game.get("stats_id"):
+        _update(room, {"$set": {"ended_at": datetime.utcnow()}})
+
+
+def record_redeem(room: Room, user: Player) -> None:
+    if not _tracked(room, user):
+        return
+    update = {"$inc": {f"{_key(user)}.codes_redeemed": 1}}
+    started_at = room.game.get("started_at")
+    if started_at:
+        seconds = int((datetime.utcnow() - started_at).total_seconds())
+        update["$min"] = {f"{_key(user)}.first_discovery": seconds}
+    _update(room, update)
+
+
+def record_kick(room: Room, user: Player, opponent: Player) -> None:
+    # Called after room.kick, so the opponent is already counted as eliminated
+    if not room.game.get("stats_id"):
+        return
+    inc = {"eliminated": 1}
+    if _tracked(room, user) and user is not opponent:
+        inc[f"{_key(user)}.kicks"] = 1
+    update = {"$inc": inc}
+    if _tracked(room, opponent):
+        update["$set"] = {f"{_key(opponent)}.eliminated": room.eliminated()}
+    _update(room, update)
+
+
+def record_special(room: Room, user: Player) -> None:
+    if not _tracked(room, user):
+        return
+    _update(room, {"$inc": {f"{_key(user)}.specials_used": 1}})
+
+
+def leaderboard_text(room: Room) -> str:
+    if not room.game.get("stats_id"):
+        return "Статистики пока нет."
+    # Reads what the last periodic flush wrote, at most FLUSH_INTERVAL behind
+    doc = stats.find_one({"_id": room.game["stats_id"]})
+    if not doc or not doc.get("players"):
+        return "Статистики пока нет."
+    rows = sorted(
+        doc["players"].items(),
+        key=lambda kv: (
+            -kv[1].get("kicks", 0),
+            -kv[1].get("codes_redeemed", 0),
+            int(kv[0]),
+        ),
+    )
+    lines = []
+    for number, p in rows:
+        first = p.get("first_discovery")
+        out = p.get("eliminated")
+        lines.append(
+            f"{number_to_square(int(number))} {p.get('name', '')}: "
+            f"нажатия {p.get('kicks', 0)}, коды {p.get('codes_redeemed', 0)}, "
+            f"особые {p.get('specials_used', 0)}, "
+            f"первый код {f'{first} с' if first is not None else '-'}, "
+            f"{f'выбыл {out}-м' if out else 'в игре'}"
+        )
+    return "Статистика игры:\n" + "\n".join(lines)
@@ -0,0 +1,37 @@
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeCollection:
+    # Records bulk writes; `fail` holds (exception, ops applied before it) pairs
+    # to raise on the next calls
+    def __init__(self) -> None:
+        self.written = []
+        self.fail = []
+
+    def bulk_write(self, ops, ordered=True):
+        if self.fail:
+            error, applied = self.fail.pop(0)
+            self.written.extend(ops[:applied])
+            raise error
+        self.written.extend(ops)
+
+
+class FakeDB(dict):
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+
+# storage connects to MongoDB at import; the modules under test only need its
+# names, so tests run against this stand-in instead
+storage = types.ModuleType("storage")
+storage.db = FakeDB()
+storage.games = storage.users = storage.buttons = storage.stats = None
+storage.ADMIN_IDS = [1]
+storage.START_KEYBOARD = None
+storage.SQUARE_NUMBERS = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣"]
+sys.modules["storage"] = storage
@@ -0,0 +1,208 @@
+from bson import ObjectId
+
+import engine
+from engine import Room
+
+
+def new_room(players=0, codes=()):
+    room = Room.load({"_id": ObjectId(), "status": "waiting", "admin_ids": [1]}, [], [])
+    room.join(1, "admin", None, None)
+    for n in range(players):
+        room.join(100 + n, f"p{n}", None, None)
+    room.add_codes(list(codes))
+    room.take_pending()
+    return room
+
+
+def started(players=3):
+    room = new_room(players, [f"C{n}" for n in range(players)])
+    assert room.start() == engine.STARTED
+    room.take_pending()
+    return room
+
+
+def code_of(room, player):
+    return room.own_button(player).code
+
+
+def test_load_creates_standard_buttons():
+    room = Room.load({"_id": ObjectId()}, [], [])
+    assert sorted(room.buttons) == list(range(1, engine.MAX_PLAYERS + 1))
+    assert [c for c, _ in room.pending] == ["buttons"] * engine.MAX_PLAYERS
+
+
+def test_join_numbers_players_and_takes_their_button():
+    room = new_room()
+    outcome, p = room.join(100, "p", None, None)
+    assert outcome == engine.JOINED
+    assert p.number == 1
+    assert room.buttons[1].player_id == p.id
+    assert room.join(100, "p", None, None) == (engine.EXISTING, p)
+
+
+def test_admin_joins_without_number():
+    room = new_room()
+    admin = room.player(1)
+    assert admin.is_admin and admin.number is None
+
+
+def test_join_is_capped():
+    room = new_room(engine.MAX_PLAYERS)
+    assert room.join(999, "late", None, None) == (engine.FULL, None)
+
+
+def test_join_refused_while_running():
+    room = started()
+    assert room.join(999, "late", None, None) == (engine.ALREADY_RUNNING, None)
+    outcome, admin = room.join(1, "admin", None, None)
+    assert outcome == engine.EXISTING
+
+
+def test_start_needs_a_code_per_player():
+    room = new_room(3, ["A", "B"])
+    assert room.start() == engine.NOT_ENOUGH_CODES
+    assert not room.running
+
+
+def test_start_assigns_codes_and_keeps_the_rest():
+    room = new_room(2, ["A", "B", "C"])
+    assert room.start() == engine.STARTED
+    assert room.running
+    assigned = {b.code for b in room.buttons.values() if b.player_id}
+    assert len(assigned) == 2
+    assert room.game["codes"] == list({"A", "B", "C"} - assigned)
+    assert room.start() == engine.ALREADY_RUNNING
+
+
+def test_add_codes_skips_codes_in_use():
+    room = new_room()
+    assert room.add_codes(["A", "B", "A"]) == ["A", "B"]
+    assert room.add_special("S")
+    assert room.add_codes(["B", "S", "C"]) == ["C"]
+    assert not room.add_special("A")
+    assert not room.add_special("S")
+
+
+def test_redeem_outcomes():
+    room = started(3)
+    a, b, c = (room.player(100 + n) for n in range(3))
+    assert room.redeem(a, "NOPE") == (engine.UNKNOWN, None)
+    assert room.redeem(a, code_of(room, b)) == (engine.FOUND, b)
+    assert b.id in a.discovered
+    # The code is used up now, for everyone
+    assert room.redeem(c, code_of(room, b)) == (engine.UNKNOWN, None)
+    a.discovered.append(c.id)
+    assert room.redeem(a, code_of(room, c)) == (engine.ALREADY_FOUND, c)
+    room.own_button(c).blocked = True
+    assert room.redeem(b, code_of(room, c)) == (engine.BLOCKED, None)
+
+
+def test_redeem_special_once():
+    room = started(2)
+    room.add_special("S")
+    a, b = room.player(100), room.player(101)
+    outcome, special = room.redeem(a, "S")
+    assert outcome == engine.FOUND_SPECIAL
+    assert special.id in a.specials
+    assert room.redeem(b, "S") == (engine.UNKNOWN, None)
+    assert not room.is_known("S")
+
+
+def test_is_known():
+    room = started(2)
+    assert room.is_known(code_of(room, room.player(100)))
+    assert not room.is_known("NOPE")
+
+
+def test_kick_hands_over_the_opponents_buttons():
+    room = started(3)
+    a, b, c = (room.player(100 + n) for n in range(3))
+    room.redeem(a, code_of(room, b))
+    room.redeem(b, code_of(room, c))
+    outcome, inherited = room.kick(a, b)
+    assert outcome == engine.KICKED
+    assert not b.alive and b.kicked_by == a.id
+    assert room.own_button(b).blocked
+    assert inherited == [(a, c)]
+    assert c.id in a.discovered
+    assert room.eliminated() == 1
+
+
+def test_self_kick_spreads_buttons_to_the_others():
+    room = started(3)
+    a, b, c = (room.player(100 + n) for n in range(3))
+    room.redeem(a, code_of(room, a))
+    room.redeem(a, code_of(room, b))
+    outcome, inherited = room.kick(a, a)
+    assert outcome == engine.KICKED
+    assert not a.alive
+    assert inherited and {r for r, _ in inherited} <= {b, c}
+    assert all(owner is b for _, owner in inherited)
+    assert any(b.id in r.discovered for r in (b, c))
+
+
+def test_kick_refusals():
+    room = new_room(2)
+    a, b = room.player(100), room.player(101)
+    a.discovered.append(b.id)
+    assert room.kick(a, b) == (engine.NOT_RUNNING, [])
+    room = started(3)
+    a, b, c = (room.player(100 + n) for n in range(3))
+    assert room.kick(a, b) == (engine.UNAVAILABLE, [])
+    room.redeem(a, code_of(room, b))
+    room.redeem(c, code_of(room, a))
+    assert room.kick(c, a)[0] == engine.KICKED
+    # Kicked players cannot kick, and nobody can kick the same player twice
+    assert room.kick(a, b) == (engine.OUT, [])
+    assert room.kick(c, a) == (engine.UNAVAILABLE, [])
+
+
+def test_use_special_reshuffles_once():
+    room = started(3)
+    room.add_special("S")
+    a = room.player(100)
+    _, special = room.redeem(a, "S")
+    version = room.game.get("version", 0)
+    owners = {b.player_id for b in room.buttons.values() if b.player_id}
+    assert room.use_special(a, special) == engine.SWITCHED
+    assert special.blocked and special.id not in a.specials
+    assert room.game["version"] == version + 1
+    assert {b.player_id for b in room.buttons.values() if b.player_id} == owners
+    assert sorted(room.buttons) == list(range(1, engine.MAX_PLAYERS + 1))
+    assert room.use_special(a, special) == engine.UNAVAILABLE
+    assert room.game["version"] == version + 1
+
+
+def test_use_special_needs_it_to_be_yours():
+    room = started(2)
+    room.add_special("S")
+    a, b = room.player(100), room.player(101)
+    _, special = room.redeem(a, "S")
+    assert room.use_special(b, special) == engine.UNAVAILABLE
+    a.alive = False
+    assert room.use_special(a, special) == engine.OUT
+
+
+def test_end_moves_to_a_fresh_generation():
+    room = started(3)
+    room.add_special("S")
+    room.take_pending()
+    version = room.game.get("version", 0)
+    room.end([1])
+    assert room.generation == 1
+    assert room.game["status"] == "waiting"
+    assert room.game["version"] == version + 1
+    assert list(room.players) == [1]
+    assert room.player(1).is_admin
+    assert not room.specials and not room.codes
+    assert all(b.player_id is None for b in room.buttons.values())
+    collections = [c for c, _ in room.take_pending()]
+    assert collections[0] == "generations"
+    assert collections.count("buttons") == engine.MAX_PLAYERS
+
+
+def test_shuffle_pairs_is_queued_with_the_version_bump():
+    room = new_room(2)
+    room.shuffle_pairs()
+    pending = room.take_pending()
+    assert [c for c, _ in pending] == ["buttons"] * engine.MAX_PLAYERS + ["games"]
@@ -0,0 +1,180 @@
+"""Query-plan regression tests.
+
+Seed a scratch database with several game runs, apply the index catalogue and
+explain every query shape the bot issues. A shape fails if it uses COLLSCAN or
+examines far more documents than it returns. Skipped when no MongoDB answers:
+
+    MONGO_URI=mongodb://localhost:27017 python -m pytest tests/test_query_plans.py
+"""
+
+import json
+import os
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import ServerSelectionTimeoutError
+
+from indexes import ensure_indexes
+
+GENERATIONS = 20
+PLAYERS = 9
+SPECIALS = 3
+ADMIN_ID = 1000
+GEN = GENERATIONS - 1
+
+# Documents the _id shapes look up
+PLAYER_ID = ObjectId()
+SPECIAL_ID = ObjectId()
+STATS_ID = ObjectId()
+OUTBOX_ID = ObjectId()
+
+# Collections that only ever hold one document
+SINGLETONS = {"games"}
+
+SHAPES = [
+    # utils.py: the room is loaded once, then written by _id
+    ("get_room game", "games", {}, None),
+    ("get_room players", "users", {"generation": GEN}, None),
+    ("get_room buttons", "buttons", {"generation": GEN}, None),
+    ("write player", "users", {"_id": PLAYER_ID}, None),
+    ("write button", "buttons", {"_id": SPECIAL_ID}, None),
+    # stats.py
+    ("leaderboard", "stats", {"_id": STATS_ID}, None),
+    # admin.py
+    (
+        "expired generations",
+        "generations",
+        {"archived_at": {"$lt": datetime.utcnow() - timedelta(days=10)}},
+        None,
+    ),
+    ("purge users", "users", {"generation": 3}, None),
+    ("purge buttons", "buttons", {"generation": 3}, None),
+    ("purge stats", "stats", {"_id": STATS_ID}, None),
+    # outbox.py
+    (
+        "next due message",
+        "outbox",
+        {"status": "pending", "due_at": {"$lte": datetime.utcnow()}},
+        [("due_at", 1), ("_id", 1)],
+    ),
+    ("finish message", "outbox", {"_id": OUTBOX_ID}, None),
+]
+
+
+def seed(db) -> None:
+    ensure_indexes(db)
+    for gen in range(GENERATIONS):
+        player_ids = [ObjectId() for _ in range(PLAYERS)]
+        if gen == GEN:
+            player_ids[1] = PLAYER_ID
+        db.users.insert_one(
+            {
+                "generation": gen,
+                "telegram_id": ADMIN_ID,
+                "isAdmin": True,
+                "alive": True,
+                "number": None,
+            }
+        )
+        db.users.insert_many(
+            [
+                {
+                    "_id": pid,
+                    "generation": gen,
+                    "telegram_id": ADMIN_ID + 1 + n,
+                    "isAdmin": False,
+                    "alive": n % 3 != 0,
+                    "number": n + 1,
+                    "discovered_opponent_ids": player_ids[:n],
+                    "special_button_ids": [],
+                }
+                for n, pid in enumerate(player_ids)
+            ]
+        )
+        db.buttons.insert_many(
+            [
+                {
+                    "generation": gen,
+                    "number": n + 1,
+                    "circle": str(n),
+                    "code": f"G{gen}C{n}",
+                    "player_id": pid,
+                    "special": False,
+                    "taken": True,
+                    "blocked": n % 3 == 0,
+                    "code_used": n % 2 == 0,
+                }
+                for n, pid in enumerate(player_ids)
+            ]
+            + [
+                {
+                    "_id": SPECIAL_ID if gen == GEN and n == 0 else ObjectId(),
+                    "generation": gen,
+                    "slot": n + 1,
+                    "code": f"G{gen}S{n}",
+                    "special": True,
+                    "taken": n == 0,
+                    "blocked": False,
+                    "code_used": False,
+                }
+                for n in range(SPECIALS)
+            ]
+        )
+        db.stats.insert_one(
+            {"_id": STATS_ID if gen == GEN else ObjectId(), "generation": gen}
+        )
+        if gen < GEN:
+            db.generations.insert_one(
+                {"_id": gen, "archived_at": datetime.utcnow() - timedelta(days=gen)}
+            )
+    db.games.insert_one({"status": "running", "generation": GEN})
+    db.outbox.insert_many(
+        [
+            {
+                "_id": OUTBOX_ID if n == 0 else ObjectId(),
+                "chat_id": ADMIN_ID + n,
+                "text": "-",
+                "status": "pending" if n < PLAYERS else "sent",
+                "due_at": datetime.utcnow() + timedelta(seconds=n - PLAYERS),
+                "done_at": None if n < PLAYERS else datetime.utcnow(),
+            }
+            for n in range(PLAYERS * 3)
+        ]
+    )
+
+
+@pytest.fixture(scope="module")
+def db():
+    client = MongoClient(
+        os.getenv("MONGO_URI", "mongodb://localhost:27017"),
+        serverSelectionTimeoutMS=2000,
+    )
+    try:
+        client.admin.command("ping")
+    except ServerSelectionTimeoutError:
+        pytest.skip("no MongoDB to explain queries against")
+    database = client[os.getenv("PLANS_DB", "tg-game-plans")]
+    client.drop_database(database.name)
+    seed(database)
+    yield database
+    client.drop_database(database.name)
+    client.close()
+
+
+@pytest.mark.parametrize(
+    "collection,query,sort", [shape[1:] for shape in SHAPES], ids=[s[0] for s in SHAPES]
+)
+def test_query_uses_an_index(db, collection, query, sort):
+    cursor = db[collection].find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    plan = cursor.explain()
+    if collection in SINGLETONS:
+        return
+    assert '"COLLSCAN"' not in json.dumps(plan["queryPlanner"], default=str)
+    stats = plan["executionStats"]
+    examined, returned = stats["totalDocsExamined"], stats["nReturned"]
+    # A little slack for residual predicates the index cannot answer
+    assert examined <= 2 * returned + PLAYERS + 1, f"examined {examined} for {returned}"
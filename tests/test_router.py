@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import pytest
+
+import router
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(router.time, "monotonic", lambda: now[0])
+    router.recent.clear()
+    return now
+
+
+def query(data, message_id=1, chat_id=10):
+    message = SimpleNamespace(chat_id=chat_id, message_id=message_id)
+    return SimpleNamespace(message=message, data=data)
+
+
+def test_second_tap_is_a_duplicate(clock):
+    assert not router.is_duplicate(query("k:1:0"))
+    assert router.is_duplicate(query("k:1:0"))
+
+
+def test_other_messages_and_data_are_not_duplicates(clock):
+    assert not router.is_duplicate(query("k:1:0"))
+    assert not router.is_duplicate(query("k:2:0"))
+    assert not router.is_duplicate(query("k:1:0", message_id=2))
+    assert not router.is_duplicate(query("k:1:0", chat_id=11))
+
+
+def test_duplicate_window_expires(clock):
+    assert not router.is_duplicate(query("k:1:0"))
+    clock[0] += router.DUPLICATE_TTL
+    assert not router.is_duplicate(query("k:1:0"))
+
+
+def test_expired_entries_are_pruned(clock):
+    for n in range(1001):
+        router.is_duplicate(query(f"k:{n}:0"))
+    clock[0] += router.DUPLICATE_TTL
+    router.is_duplicate(query("k:x:0"))
+    assert list(router.recent) == [(10, 1, "k:x:0")]
@@ -0,0 +1,98 @@
+import pytest
+from bson import ObjectId
+from pymongo import InsertOne
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+import utils
+from engine import Room
+from storage import db
+
+
+@pytest.fixture
+def room():
+    db.clear()
+    utils._room = Room({"_id": ObjectId()})
+    yield utils._room
+    utils._room = None
+
+
+def insert(n):
+    return InsertOne({"n": n})
+
+
+def written(collection):
+    return [op._doc["n"] for op in db[collection].written]
+
+
+def duplicate_at(index):
+    return BulkWriteError({"writeErrors": [{"index": index, "code": 11000}]})
+
+
+def test_flush_sends_batches_in_order(room):
+    for collection, n in [("users", 1), ("users", 2), ("buttons", 3), ("users", 4)]:
+        room.queue(collection, insert(n))
+    utils.flush_room()
+    assert written("users") == [1, 2, 4]
+    assert written("buttons") == [3]
+    assert room.pending == []
+
+
+def test_flush_drops_a_write_that_can_never_succeed(room):
+    for n in range(4):
+        room.queue("buttons", insert(n))
+    db["buttons"].fail.append((duplicate_at(1), 1))
+    utils.flush_room()
+    # The op before the error went in with the batch, the ones after it in a retry
+    assert written("buttons") == [0, 2, 3]
+    assert room.pending == []
+    room.queue("buttons", insert(4))
+    utils.flush_room()
+    assert written("buttons") == [0, 2, 3, 4]
+
+
+def test_flush_requeues_after_a_connection_error(room):
+    room.queue("users", insert(1))
+    room.queue("buttons", insert(2))
+    room.queue("buttons", insert(3))
+    db["buttons"].fail.append((AutoReconnect("down"), 0))
+    with pytest.raises(AutoReconnect):
+        utils.flush_room()
+    assert written("users") == [1]
+    assert [op._doc["n"] for _, op in room.pending] == [2, 3]
+    # Writes made meanwhile go after the ones that are waiting
+    room.queue("buttons", insert(4))
+    utils.flush_room()
+    assert written("buttons") == [2, 3, 4]
+    assert room.pending == []
+
+
+class Item:
+    def __init__(self, number):
+        self.number = number
+
+
+def numbers(items):
+    return [i.number for i in items]
+
+
+def test_page_walks_forward_and_back():
+    items = [Item(n) for n in range(20, 0, -1)]
+    first, has_prev, has_next = utils.page(items, "number", [])
+    assert numbers(first) == list(range(1, utils.PAGE_SIZE + 1))
+    assert (has_prev, has_next) == (False, True)
+    second, has_prev, has_next = utils.page(items, "number", [">", "8"])
+    assert numbers(second) == list(range(9, 17))
+    assert (has_prev, has_next) == (True, True)
+    last, has_prev, has_next = utils.page(items, "number", [">", "16"])
+    assert numbers(last) == [17, 18, 19, 20]
+    assert (has_prev, has_next) == (True, False)
+    back, has_prev, has_next = utils.page(items, "number", ["<", "9"])
+    assert numbers(back) == numbers(first)
+    assert (has_prev, has_next) == (False, True)
+
+
+def test_page_buttons_only_for_existing_neighbours():
+    items = [Item(n) for n in range(1, 4)]
+    assert utils.page_buttons("menu_list", items, "number", False, False) == []
+    (row,) = utils.page_buttons("menu_list", items, "number", True, True)
+    assert [b.callback_data for b in row] == ["menu_list:<:1", "menu_list:>:3"]
@@ -1,21 +1,135 @@
-from typing import Dict
+import logging
+from itertools import groupby
+from typing import Dict, List, Optional, Tuple
 
+from pymongo.errors import BulkWriteError, PyMongoError
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
-from storage import games, ADMIN_IDS, START_KEYBOARD, SQUARE_NUMBERS, buttons
+import profiling
+from engine import Room
+from router import encode
+from storage import (
+    db,
+    games,
+    users,
+    ADMIN_IDS,
+    START_KEYBOARD,
+    SQUARE_NUMBERS,
+    buttons,
+)
 
+logger = logging.getLogger(__name__)
 
-def get_name(user: Dict) -> str:
-    return "@" + (user.get("username") or user.get("first_name") or "user")
+_room: Optional[Room] = None
+
+
+def get_name(user) -> str:
+    return "@" + (user.username or user.first_name or "user")
+
+
+def get_room() -> Room:
+    global _room
+    if _room is None:
+        game = games.find_one()
+        if not game:
+            game = {
+                "status": "waiting",
+                "admin_ids": ADMIN_IDS,
+                "codes": [],
+                "version": 0,
+                "generation": 0,
+            }
+            games.insert_one(game)
+        generation = game.get("generation", 0)
+        _room = Room.load(
+            game,
+            users.find({"generation": generation}),
+            buttons.find({"generation": generation}),
+        )
+    return _room
 
 
 def get_game() -> Dict:
-    game = games.find_one()
-    if not game:
-        game = {"status": "waiting", "admin_ids": ADMIN_IDS, "codes": []}
-        games.insert_one(game)
-    return game
+    return get_room().game
+
+
+def flush_room() -> None:
+    # Consecutive writes to one collection go out as one ordered bulk_write;
+    # the batches themselves are sent in the order the mutations happened
+    if _room is None:
+        return
+    pending = _room.take_pending()
+    sent = 0
+    try:
+        for collection, batch in groupby(pending, key=lambda item: item[0]):
+            ops = [op for _, op in batch]
+            while ops:
+                try:
+                    db[collection].bulk_write(ops, ordered=True)
+                    done = len(ops)
+                except BulkWriteError as e:
+                    # An ordered batch stops at the first error and everything
+                    # before it is in. A write error (duplicate key, validation)
+                    # fails the same way every time, so that op is dropped
+                    errors = e.details.get("writeErrors") or []
+                    if not errors:
+                        logger.warning("%s write concern not met: %s", collection, e)
+                        done = len(ops)
+                    else:
+                        done = errors[0]["index"] + 1
+                        logger.error(
+                            "Dropped %s write %r: %s",
+                            collection,
+                            ops[done - 1],
+                            errors[0].get("errmsg"),
+                        )
+                sent += done
+                ops = ops[done:]
+    except PyMongoError:
+        # Connection trouble: whatever did not reach the database goes back to
+        # the head of the queue and is sent again by the next flush
+        _room.pending[:0] = pending[sent:]
+        raise
+
+
+async def flush_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    flush_room()
+
+
+PAGE_SIZE = 8
+
+
+def page(items: List, key: str, args: List[str]) -> Tuple[List, bool, bool]:
+    # Keyset pagination over items sorted by `key`: args are [] for the first
+    # page, or [">" | "<", key value] taken from the last/first row of the page
+    # being left
+    items = sorted(items, key=lambda i: getattr(i, key) or 0)
+    if args and args[0] == "<":
+        before = [i for i in items if (getattr(i, key) or 0) < int(args[1])]
+        return before[-PAGE_SIZE:], len(before) > PAGE_SIZE, True
+    if args:
+        items = [i for i in items if (getattr(i, key) or 0) > int(args[1])]
+    return items[:PAGE_SIZE], bool(args), len(items) > PAGE_SIZE
+
+
+def page_buttons(
+    action: str, items: List, key: str, has_prev: bool, has_next: bool
+) -> List[List[InlineKeyboardButton]]:
+    row = []
+    if has_prev and items:
+        row.append(
+            InlineKeyboardButton(
+                "◀️", callback_data=encode(action, "<", getattr(items[0], key))
+            )
+        )
+    if has_next and items:
+        row.append(
+            InlineKeyboardButton(
+                "▶️", callback_data=encode(action, ">", getattr(items[-1], key))
+            )
+        )
+    return [row] if row else []
 
 
 def is_admin(game: Dict, tg_id: int) -> bool:
@@ -29,15 +143,11 @@ def number_to_square(n) -> str:
 
 
 def number_to_circle(n) -> str:
-    if isinstance(n, int):
-        pair = buttons.find_one({"number": n, "special": False})
-        if pair:
-            return pair.get("circle", "")
-    return ""
+    return get_room().circle(n) if isinstance(n, int) else ""
 
 
 async def send_menu(
-    chat_id: int, user: Dict, game: Dict, context: ContextTypes.DEFAULT_TYPE
+    chat_id: int, user, game: Dict, context: ContextTypes.DEFAULT_TYPE
 ) -> None:
     if game.get("status") != "running" and not is_admin(game, chat_id):
         await context.bot.send_message(chat_id, "Игра еще не началась.")
@@ -61,9 +171,7 @@ async def send_menu(
             keyboard.append(
                 [InlineKeyboardButton("Игроки", callback_data="player_list")]
             )
-            keyboard.append(
-                [InlineKeyboardButton("Пары", callback_data="show_pairs")]
-            )
+            keyboard.append([InlineKeyboardButton("Пары", callback_data="show_pairs")])
             keyboard.append(
                 [
                     InlineKeyboardButton(
@@ -75,14 +183,37 @@ async def send_menu(
             keyboard.append(
                 [
                     InlineKeyboardButton("Завершить игру", callback_data="end_game"),
-                    InlineKeyboardButton(
-                        "Список игроков", callback_data="player_list"
-                    ),
+                    InlineKeyboardButton("Список игроков", callback_data="player_list"),
                 ]
             )
             keyboard.append(
                 [InlineKeyboardButton("Кнопки", callback_data="button_status")]
             )
+        keyboard.append(
+            [
+                InlineKeyboardButton("Статистика", callback_data="leaderboard"),
+                InlineKeyboardButton(
+                    (
+                        "Отключить панель"
+                        if str(chat_id) in game.get("dashboards", {})
+                        else "Живая панель"
+                    ),
+                    callback_data="dashboard",
+                ),
+            ]
+        )
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    (
+                        "Остановить профилирование"
+                        if profiling.is_running()
+                        else "Профилирование"
+                    ),
+                    callback_data="profile",
+                )
+            ]
+        )
     if keyboard:
         await context.bot.send_message(
             chat_id, "Выберите действие:", reply_markup=InlineKeyboardMarkup(keyboard)